@@ -5,6 +5,9 @@ from getpass import getpass
 from loguru import logger
 
 
+MAX_LOGIN_ATTEMPTS = 3
+
+
 class CMSAuthenticationError(Exception):
     """The CMSAuthenticationError class is raised when the user's credentials
     are invalid."""
@@ -50,19 +53,21 @@ class Credentials:
             f.write(f"{self.username}\n{self.password}")
 
     def __get_credentials_from_input(self) -> None:
-        from scraper import Scraper
-
         """
         Get credentials from input.
         """
-        self.username = input("GUC Username: ")
-        self.password = getpass(prompt="GUC Password: ")
-        try:
-            Scraper(credentials=self).authenticate()
-            return
-        except CMSAuthenticationError:
-            logger.error("Authentication failed. Please try again.")
-            self.__get_credentials_from_input()
+        # imported here to avoid a circular import with scraper
+        from scraper import Scraper
+
+        for _ in range(MAX_LOGIN_ATTEMPTS):
+            self.username = input("GUC Username: ")
+            self.password = getpass(prompt="GUC Password: ")
+            try:
+                Scraper(credentials=self).authenticate()
+                return
+            except CMSAuthenticationError:
+                logger.error("Authentication failed. Please try again.")
+        raise CMSAuthenticationError("Too many failed login attempts.")
 
     def remove_credentials(self) -> None:
         """
@@ -1,11 +1,18 @@
 import yaml
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
 
 YML_FILE = "config.yml"
-YML_CONFIG = yaml.safe_load(open(YML_FILE))
+with open(YML_FILE) as f:
+    YML_CONFIG = yaml.load(f, Loader=SafeLoader)
 
 HOST = YML_CONFIG["host"]
 DOWNLOADS_DIR = YML_CONFIG["downloads_dir"]
+HTML_PARSER = YML_CONFIG.get("html_parser", "lxml")
 
 ALLOWED_EXTENSIONS = YML_CONFIG["allowed_extensions"]
 
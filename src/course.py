@@ -2,11 +2,29 @@ from loguru import logger
 
 import os
 import re
-from datetime import datetime
+from functools import lru_cache
+from urllib.parse import parse_qs, unquote, urlparse
 
 from bs4 import BeautifulSoup
 from config import ALLOWED_EXTENSIONS, HOST
-from sanitize_filename import sanitize
+from sanitize_filename import sanitize as _sanitize
+
+# sanitize runs several regex substitutions per call; many inputs repeat
+sanitize = lru_cache(maxsize=1024)(_sanitize)
+
+COURSE_REGEX = re.compile(r"\n*[\(][\|]([^\|]*)[\|][\)]([^\(]*)[\(].*\n*")
+FILE_REGEX = re.compile(r"[0-9]* - (.*)")
+
+
+@lru_cache(maxsize=64)
+def format_week(week: str) -> str:
+    """
+    Turn a "Week: YYYY-MM-DD" header into the "W MM-DD" directory label.
+    Cached since all files of a week share the same header.
+    """
+    week = week.removeprefix("Week: ")
+    # week is "YYYY-MM-DD"; keep the "MM-DD" part
+    return f"W {week[5:]}"
 
 
 class Course:
@@ -16,8 +34,10 @@ class Course:
 
     def __init__(self, course_url: str) -> None:
         self.course_url = course_url
-        self.id = self.course_url.split("id")[1][1:].split("&")[0]
+        self.id = parse_qs(urlparse(course_url).query)["id"][0]
         self.files = []
+        self.etag = None
+        self.cached_files = None
 
     def __str__(self) -> str:
         return f"[{self.course_code}] {self.course_name}"
@@ -26,15 +46,7 @@ class Course:
 
     @staticmethod
     def get_course_regex() -> re.Pattern:
-        return re.compile(r"\n*[\(][\|]([^\|]*)[\|][\)]([^\(]*)[\(].*\n*")
-
-    @property
-    def course_code(self) -> None:
-        return self.course_text.split("-")[0].strip()
-
-    @property
-    def course_name(self) -> None:
-        return self.course_text.split("-")[1].strip()
+        return COURSE_REGEX
 
     def set_course_text(self, course_text: str) -> None:
         """
@@ -44,45 +56,62 @@ class Course:
         :param course_text: The course text.
         """
         self.course_text = course_text
+        code, _, name = course_text.partition("-")
+        self.course_code = code.strip()
+        self.course_name = name.strip()
 
     def create_course_directory(self) -> None:
-        for file in self.files:
-            os.makedirs(os.path.join(file.dir_path), exist_ok=True)
+        for dir_path in {file.dir_path for file in self.files}:
+            os.makedirs(dir_path, exist_ok=True)
 
     def set_course_soup(self, course_soup: BeautifulSoup) -> None:
         self.course_soup = course_soup
 
+    def set_cached_files(self, files_data: list[dict]) -> None:
+        """
+        Use a previously crawled file listing instead of parsing the course page.
+        """
+        self.cached_files = files_data
+
     def get_course_files(self, course_path) -> None:
         """
-        Get the list of files in the course.
+        Get the list of files in the course, one week section at a time.
+        The listing is always complete; already-downloaded files are
+        filtered out later so the on-disk course cache stays whole.
         """
-        files_body = self.course_soup.find_all(class_="card-body")
+        if self.cached_files is not None:
+            self.files = [CMSFile.from_cache(data, course_path, self.course_name) for data in self.cached_files]
+            return
 
-        for item in files_body:
-            # check if the card is not a course content, useful for `Filter weeks` card
-            if item.find("strong") is None:
+        for header in self.course_soup.find_all("h2"):
+            week_text = header.text.strip()
+            if not week_text.startswith("Week"):
                 continue
-            self.files.append((CMSFile(soup=item, course_path=course_path, course_name=self.course_name)))
+            for item in header.parent.find_all(class_="card-body"):
+                # check if the card is not a course content, useful for `Filter weeks` card
+                if item.find("strong") is None:
+                    continue
+                self.files.append(
+                    CMSFile(soup=item, course_path=course_path, course_name=self.course_name, week=week_text)
+                )
 
 
 class CMSFile:
     """a cms file object"""
 
-    def __init__(self, soup: BeautifulSoup, course_path: str, course_name: str) -> None:
+    def __init__(self, soup: BeautifulSoup, course_path: str, course_name: str, week: str) -> None:
         self.soup = soup
         self.course_name = course_name
 
         self.url = HOST + self.soup.find("a")["href"]
 
-        self.week = self.soup.parent.parent.parent.parent.find("h2").text.strip()
-        self.week = re.sub(r"Week: (.*)", "\\1", self.week)
-        self.week = datetime.strptime(self.week, "%Y-%m-%d").strftime("W %m-%d")
+        self.week = format_week(week)
 
-        self.description = re.sub(self.get_file_regex(), "\\1", self.soup.find("div").text).strip()
+        self.description = FILE_REGEX.sub("\\1", self.soup.find("div").text).strip()
 
-        self.name = re.sub(self.get_file_regex(), "\\1", self.soup.find("strong").text).strip()
+        self.name = FILE_REGEX.sub("\\1", self.soup.find("strong").text).strip()
         self.name = sanitize(self.name)
-        self.extension = self.url.rsplit(".", 1)[1]
+        self.extension = os.path.splitext(unquote(urlparse(self.url).path))[1].lstrip(".")
         if self.extension not in ALLOWED_EXTENSIONS:
             logger.warning(
                 f"File extension {self.extension} is not allowed. File: {self.name} skipped.\n"
@@ -92,9 +121,34 @@ class CMSFile:
         self.dir_path = os.path.join(course_path, self.week)
         self.path = os.path.join(self.dir_path, f"{self.name}.{self.extension}")
 
+    @classmethod
+    def from_cache(cls, data: dict, course_path: str, course_name: str) -> "CMSFile":
+        """
+        Rebuild a file from a cached listing, skipping the HTML parse.
+        """
+        file = cls.__new__(cls)
+        file.course_name = course_name
+        file.url = data["url"]
+        file.week = data["week"]
+        file.description = data["description"]
+        file.name = data["name"]
+        file.extension = data["extension"]
+        file.dir_path = os.path.join(course_path, file.week)
+        file.path = os.path.join(file.dir_path, f"{file.name}.{file.extension}")
+        return file
+
+    def to_cache(self) -> dict:
+        return {
+            "url": self.url,
+            "week": self.week,
+            "name": self.name,
+            "extension": self.extension,
+            "description": self.description,
+        }
+
     @staticmethod
     def get_file_regex() -> re.Pattern:
-        return re.compile(r"[0-9]* - (.*)")
+        return FILE_REGEX
 
     def __str__(self) -> str:
         return f"{self.name}"
@@ -1,21 +1,39 @@
-import threading
 import os
-import random
 import re
 import json
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property
+from itertools import cycle
 
 import requests
-from bs4 import BeautifulSoup
+import requests_cache
+import urllib3
+from bs4 import BeautifulSoup, SoupStrainer
 from requests.adapters import HTTPAdapter, Retry
 
-from config import ALLOWED_EXTENSIONS, DOWNLOADS_DIR, HOST, TQDM_COLORS
-from course import CMSFile, Course
+from config import ALLOWED_EXTENSIONS, DOWNLOADS_DIR, HOST, HTML_PARSER, TQDM_COLORS
+from course import COURSE_REGEX, CMSFile, Course
 from requests_ntlm import HttpNtlmAuth
 from loguru import logger
 from tqdm import tqdm
+from tqdm.utils import CallbackIOWrapper
 
 from auth import Credentials, CMSAuthenticationError
 
+MAX_CONCURRENT_REQUESTS = 8
+REQUEST_TIMEOUT = 30
+
+CACHE_DIR = ".cache"
+MANIFEST_FILE = ".downloaded.json"
+
+COURSE_LINK_REGEX = re.compile(r"\/apps\/student\/CourseViewStn\?id(.*)")
+
+# only the course links and the courses table are read off the home page
+HOME_STRAINER = SoupStrainer(["a", "table"])
+
+COLOR_CYCLE = cycle(TQDM_COLORS)
+
 
 class Scraper:
     """
@@ -24,21 +42,40 @@ class Scraper:
 
     def __init__(self, credentials: Credentials):
         self.credentials: Credentials = credentials
-        self.session: requests.Session = requests.Session()
+        self.session: requests.Session = requests_cache.CachedSession(
+            ".cms_cache",
+            backend="sqlite",
+            cache_control=True,
+            expire_after=3600,
+        )
         self.session.auth = HttpNtlmAuth(credentials.username, credentials.password)
-        self.session.headers.update({"User-Agent": "Mozilla/5.0"})
-        self.html_parser: str = "html.parser"
-        self.get_args: dict[str, object] = {
-            "auth": self.session.auth,
-            "verify": False,
-        }
-
-    @property
+        self.session.headers.update({"User-Agent": "Mozilla/5.0", "Connection": "keep-alive"})
+        adapter = HTTPAdapter(
+            pool_connections=32,
+            pool_maxsize=32,
+            max_retries=Retry(total=3, backoff_factor=0.3),
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.html_parser: str = HTML_PARSER
+        self.session.verify = False
+        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+        self.downloaded: set[str] = self.__load_manifest()
+
+    @cached_property
     def home_soup(self) -> BeautifulSoup:
         """
-        Get home page.
+        Get home page. Fetched and parsed once per run.
         """
-        return BeautifulSoup(self.session.get(HOST, **self.get_args).text, self.html_parser)
+        return BeautifulSoup(
+            self.session.get(HOST, timeout=REQUEST_TIMEOUT).text, self.html_parser, parse_only=HOME_STRAINER
+        )
+
+    def invalidate_home_soup(self) -> None:
+        """
+        Drop the memoized home page so the next access re-fetches it.
+        """
+        self.__dict__.pop("home_soup", None)
 
     def run(self) -> None:
         """
@@ -51,6 +88,7 @@ class Scraper:
             self.authenticate()
         except CMSAuthenticationError:
             self.credentials.remove_credentials()
+            self.invalidate_home_soup()
             return self.run()
 
         logger.info("Authentication successful.")
@@ -60,27 +98,36 @@ class Scraper:
 
         logger.info("Scraping files...")
         self.__scrap_files()
+        self.__cache_courses_files()
 
         self.__create_courses_dir()
 
         logger.info("Downloading files...")
         self.__download_all_files()
+        self.__save_manifest()
 
     def __download_all_files(self):
-        # download files in parallel using threads
-        threads = []
-        if not self.files:
+        # download files in parallel using a bounded thread pool
+        files = self.files
+        if not files:
             logger.warning("No new files found.")
             return
-        logger.info(f"New files found. Downloading {self.files} ...")
-        for file in self.files:
-            thread = threading.Thread(target=self.__download_file, args=(file,))
-            thread.start()
-            threads.append(thread)
+        logger.info(f"New files found. Downloading {files} ...")
+        with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+            list(
+                tqdm(
+                    executor.map(self.__download_file, files),
+                    total=len(files),
+                    unit="file",
+                    dynamic_ncols=True,
+                    colour=next(COLOR_CYCLE),
+                )
+            )
 
     def __create_courses_dir(self):
-        for course in self.courses:
-            course.create_course_directory()
+        # files in the same week share a directory, create each one once
+        for dir_path in {file.dir_path for course in self.courses for file in course.files}:
+            os.makedirs(dir_path, exist_ok=True)
 
     def __scrap_courses(self) -> None:
         # cache the courses name and links
@@ -95,7 +142,7 @@ class Scraper:
         self._populate_courses_data()
         with open(".courses.json", "w") as f:
             data = {course.course_text: course.course_url for course in self.courses}
-            json.dump(data, f, indent=4)
+            json.dump(data, f, separators=(",", ":"))
 
     def __get_cached_courses(self):
         logger.info("Loading cached courses...")
@@ -117,6 +164,16 @@ class Scraper:
         for course in self.courses:
             course.get_course_files(os.path.join(DOWNLOADS_DIR, course.__str__()))
 
+    def __load_manifest(self) -> set[str]:
+        if not os.path.exists(MANIFEST_FILE):
+            return set()
+        with open(MANIFEST_FILE, "r") as f:
+            return set(json.load(f))
+
+    def __save_manifest(self) -> None:
+        with open(MANIFEST_FILE, "w") as f:
+            json.dump(sorted(self.downloaded), f, separators=(",", ":"))
+
     def _populate_courses_data(self):
         # populate courses with names
         for course, course_text in zip(self.courses, self.course_names):
@@ -129,8 +186,12 @@ class Scraper:
         """
         Authenticate with GUC CMS.
         """
+        # bypass the HTTP cache so a cached 200 can never vouch for bad credentials
         response = self.session.get(
-            HOST, **self.get_args, headers={"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64)"}
+            HOST,
+            timeout=REQUEST_TIMEOUT,
+            headers={"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64)"},
+            expire_after=requests_cache.DO_NOT_CACHE,
         )
         if response.status_code != 200:
             raise CMSAuthenticationError("Authentication failed.")
@@ -140,74 +201,134 @@ class Scraper:
         Get list of courses.
         """
         self.courses_links = [link.get("href") for link in self.home_soup.find_all("a") if link.get("href")]
-        self.courses_links = [
-            HOST + link for link in self.courses_links if re.match(r"\/apps\/student\/CourseViewStn\?id(.*)", link)
-        ]
+        self.courses_links = [HOST + link for link in self.courses_links if COURSE_LINK_REGEX.match(link)]
         return [Course(link) for link in self.courses_links]
 
     def __get_course_names(self) -> list[str]:
         "get course names"
-        courses_table = list(
-            self.home_soup.find(
-                "table",
-                {"id": "ContentPlaceHolderright_ContentPlaceHoldercontent_GridViewcourses"},
-            )
+        courses_table = self.home_soup.find(
+            "table",
+            {"id": "ContentPlaceHolderright_ContentPlaceHoldercontent_GridViewcourses"},
         )
-        return [
-            re.sub(
-                Course.get_course_regex(),
-                r"\1-\2",
-                courses_table[i].text.strip(),
-            ).strip()
-            for i in range(2, len(courses_table) - 1)
-        ]
+        return [f"{code.strip()}-{name.strip()}" for code, name in COURSE_REGEX.findall(courses_table.get_text("\n"))]
 
     def get_courses_soup(self) -> None:
         """
-        Get courses page.
+        Get courses pages concurrently.
         """
         logger.info("Getting courses pages...")
-        for course in tqdm(self.courses, unit="course", dynamic_ncols=True, colour=random.choice(TQDM_COLORS)):
-            course.set_course_soup(
-                BeautifulSoup(
-                    self.session.get(course.course_url, **self.get_args).text,
-                    self.html_parser,
+        with ThreadPoolExecutor(max_workers=min(MAX_CONCURRENT_REQUESTS, len(self.courses) or 1)) as executor:
+            list(
+                tqdm(
+                    executor.map(self.__fetch_course_soup, self.courses),
+                    total=len(self.courses),
+                    unit="course",
+                    dynamic_ncols=True,
+                    colour=next(COLOR_CYCLE),
                 )
             )
 
+    def __fetch_course_soup(self, course: Course) -> None:
+        cached_files = self.__load_course_cache(course)
+        if cached_files is not None:
+            course.set_cached_files(cached_files)
+            return
+        response = self.session.get(course.course_url, timeout=REQUEST_TIMEOUT)
+        course.etag = response.headers.get("ETag")
+        course.set_course_soup(BeautifulSoup(response.text, self.html_parser))
+
+    def __load_course_cache(self, course: Course) -> list[dict] | None:
+        """
+        Return the cached file listing if the course page is unchanged.
+        """
+        cache_path = os.path.join(CACHE_DIR, f"{course.id}.json")
+        if not os.path.exists(cache_path):
+            return None
+        # the ETag must come from the server, not from the HTTP cache being validated
+        course.etag = self.session.head(
+            course.course_url,
+            timeout=REQUEST_TIMEOUT,
+            expire_after=requests_cache.DO_NOT_CACHE,
+        ).headers.get("ETag")
+        with open(cache_path, "r") as f:
+            cached = json.load(f)
+        if course.etag is None or cached["etag"] != course.etag:
+            return None
+        return cached["files"]
+
+    def __cache_courses_files(self) -> None:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        for course in self.courses:
+            if course.cached_files is not None or course.etag is None:
+                continue
+            with open(os.path.join(CACHE_DIR, f"{course.id}.json"), "w") as f:
+                json.dump(
+                    {"etag": course.etag, "files": [file.to_cache() for file in course.files]},
+                    f,
+                    separators=(",", ":"),
+                )
+
     def __download_file(self, file: CMSFile) -> None:
-        retries = Retry(total=5, backoff_factor=0.1)
+        local_size = os.path.getsize(file.path) if os.path.exists(file.path) else 0
+        headers = {}
+        if local_size:
+            head = self.session.head(
+                file.url,
+                timeout=REQUEST_TIMEOUT,
+                allow_redirects=True,
+                expire_after=requests_cache.DO_NOT_CACHE,
+            )
+            if local_size == int(head.headers.get("Content-Length", -1)):
+                self.downloaded.add(file.url)
+                return
+            headers["Range"] = f"bytes={local_size}-"
 
-        self.session.mount("http://", HTTPAdapter(max_retries=retries))
-        response = self.session.get(file.url, **self.get_args, stream=True, allow_redirects=True)
-        if response.status_code != 200:
+        # file bodies are written to disk anyway, keep them out of the HTTP cache
+        response = self.session.get(
+            file.url,
+            timeout=REQUEST_TIMEOUT,
+            headers=headers,
+            stream=True,
+            allow_redirects=True,
+            expire_after=requests_cache.DO_NOT_CACHE,
+        )
+        if response.status_code not in (200, 206):
             logger.error(response.status_code)
             return
+        if response.status_code != 206:
+            # server ignored the Range header, restart from scratch
+            local_size = 0
 
-        total_size = int(response.headers.get("Content-Length"))
+        total_size = local_size + int(response.headers.get("Content-Length"))
 
-        with open(file.path, "wb") as f:
+        with open(file.path, "ab" if local_size else "wb", buffering=1 << 20) as f:
+            if not local_size and total_size and hasattr(os, "posix_fallocate"):
+                # pre-size the file so the filesystem can allocate it contiguously
+                os.posix_fallocate(f.fileno(), 0, total_size)
             with tqdm(
                 total=total_size,
                 unit="B",
                 unit_scale=True,
                 desc=file.path,
-                initial=0,
+                initial=local_size,
                 dynamic_ncols=True,
-                colour=random.choice(TQDM_COLORS),
+                colour=next(COLOR_CYCLE),
             ) as t:
-                for chunk in response.iter_content(chunk_size=1024):
-                    f.write(chunk)
-                    t.update(len(chunk))
+                response.raw.decode_content = True
+                shutil.copyfileobj(response.raw, CallbackIOWrapper(t.update, f, "write"), length=1 << 20)
+        self.downloaded.add(file.url)
 
-    @property
+    @cached_property
     def files(self) -> list[CMSFile]:
         """
-        Get all files.
+        Get all files that may need downloading. Files already on disk are
+        kept in the list on purpose: __download_file compares their size
+        against the server and skips or resumes them, so a partial download
+        left by a crash gets finished instead of being ignored.
         """
         return [
             file
             for course in self.courses
             for file in course.files
-            if not os.path.exists(file.path) and file.extension in ALLOWED_EXTENSIONS
+            if file.url not in self.downloaded and file.extension in ALLOWED_EXTENSIONS
         ]